@@ -1,4 +1,6 @@
 import os
+import json
+import hashlib
 import streamlit as st
 import requests
 
@@ -7,7 +9,7 @@ API_URL = os.getenv("API_URL", "http://localhost:8000")
 st.set_page_config(page_title="MEDICAL_DOC Analyzer", layout="wide", page_icon="🩺")
 
 # Optimized CSS for clean headers and failure summaries
-st.markdown("""
+CSS = """
     <style>
     .step-header {
         color: #1E3A8A; font-weight: bold; font-size: 1.4rem;
@@ -22,7 +24,9 @@ st.markdown("""
         padding: 20px; border-radius: 5px; margin-top: 10px;
     }
     </style>
-    """, unsafe_allow_html=True)
+    """
+# Streamlit rebuilds the page on every rerun, so the style block must be re-emitted each time
+st.markdown(CSS, unsafe_allow_html=True)
 
 # 2. Header
 st.title("🩺 MEDICAL_DOC Analysis System")
@@ -35,90 +39,125 @@ uploaded_files = st.file_uploader(
     accept_multiple_files=True
 )
 
+def _batch_key(files):
+    """Identifies an upload batch by file names and sizes."""
+    digest = hashlib.sha256()
+    for f in files:
+        digest.update(f"{f.name}:{f.size}\n".encode("utf-8"))
+    return digest.hexdigest()
+
+
+# 4. Result Rendering
+def render_result(item):
+    st.markdown("---")
+    st.header(f"📄 File: {item['file']}")
+    
+    analysis = item.get("analysis", {})
+    
+    # --- IF DOCUMENT FAILED: "WHY IT FAILED" SUMMARY ---
+    if analysis.get("document_status") == "FAILED":
+        st.error("Document Validation Failed")
+        
+        st.subheader("Why it failed")
+        checks = analysis.get("compliance_summary", {})
+        
+        # Map for human-friendly reasons
+        reasons = {
+            "patient_name": "Patient name is missing. A valid medical report must clearly identify the patient.",
+            "date": "Report date is missing. The document must clearly specify when it was issued.",
+            "medication": "No medications identified. This system requires a prescription list for analysis.",
+            "physician_signature": "Doctor signature or authentication details are missing."
+        }
+
+        # Generate the numbered list exactly as requested
+        fail_count = 1
+        for key, msg in reasons.items():
+            if checks.get(key) == "Missing":
+                st.markdown(f"{fail_count}. {msg}")
+                fail_count += 1
+
+        # Visual Details
+        st.write("---")
+        st.subheader("Validation Details")
+        cols = st.columns(4)
+        labels = {"patient_name": "Name", "date": "Date", "medication": "Meds", "physician_signature": "Signature"}
+        for i, (key, label) in enumerate(labels.items()):
+            status = checks.get(key, "Missing")
+            if status == "Found": cols[i].success(f"✅ {label}")
+            else: cols[i].error(f"❌ {label}")
+        return
+
+    # --- IF DOCUMENT PASSED: STEP-BY-STEP MATTER ---
+    st.success("✅ Document Verified & Analyzed Successfully")
+
+    # STEP 1: PATIENT SUMMARY
+    st.markdown("<div class='step-header'>🧑 STEP 1: PATIENT SUMMARY</div>", unsafe_allow_html=True)
+    p_data = analysis.get("patient_data", {})
+    s_data = analysis.get("summary_for_human", "No summary available.")
+    d_data = analysis.get("disease_explanation", "No disease explanation available.")
+    h_data = analysis.get("hospital_guide", "No hospital guide available.")
+
+    st.markdown(f"""
+    <div class='clinical-text'>
+    <b>Patient:</b> {p_data.get('patient_name')} | <b>Age:</b> {p_data.get('patient_age')} | <b>Sex:</b> {p_data.get('patient_sex')}<br><br>
+    {s_data}
+    </div>
+    """, unsafe_allow_html=True)
+
+    # STEP 2: DIAGNOSIS EXPLANATION
+    st.markdown("<div class='step-header'>🩺 STEP 2: DIAGNOSIS EXPLANATION</div>", unsafe_allow_html=True)
+    st.markdown(f"<div class='clinical-text'>{d_data}</div>", unsafe_allow_html=True)
+
+    # STEP 3: MEDICATION INFO
+    st.markdown("<div class='step-header'>💊 STEP 3: MEDICATION INFO</div>", unsafe_allow_html=True)
+    meds = analysis.get("medication_info", [])
+    if meds:
+        for med in meds:
+            st.markdown(f"<div class='clinical-text'>• {med}</div>", unsafe_allow_html=True)
+    else:
+        st.markdown("<div class='clinical-text'>No medications found.</div>", unsafe_allow_html=True)
+
+    # STEP 4: HOSPITAL GUIDE & NEXT STEPS
+    st.markdown("<div class='step-header'>🏥 STEP 4: HOSPITAL GUIDE & NEXT STEPS</div>", unsafe_allow_html=True)
+    st.markdown(f"<div class='clinical-text'>{h_data}</div>", unsafe_allow_html=True)
+
+
 if uploaded_files:
-    files = [("files", (f.name, f.getvalue(), f.type)) for f in uploaded_files]
+    # Streamlit reruns the script on every interaction; keep the last batch's
+    # results in session_state so the same upload isn't re-analyzed each time
+    batch_key = _batch_key(uploaded_files)
+    if st.session_state.get("results_key") != batch_key:
+        files = [("files", (f.name, f.getvalue(), f.type)) for f in uploaded_files]
 
-    with st.spinner("🔍 Running Strict Compliance Audit..."):
         try:
-            response = requests.post(f"{API_URL}/analyze", files=files)
-            results = response.json()
+            response = requests.post(f"{API_URL}/analyze", files=files, stream=True)
         except Exception as e:
             st.error(f"❌ Connection Failed: {str(e)}")
             st.stop()
 
-    # 4. Process Results
-    for item in results:
-        st.markdown("---")
-        st.header(f"📄 File: {item['file']}")
-        
-        analysis = item.get("analysis", {})
-        
-        # --- IF DOCUMENT FAILED: "WHY IT FAILED" SUMMARY ---
-        if analysis.get("document_status") == "FAILED":
-            st.error("Document Validation Failed")
-            
-            st.subheader("Why it failed")
-            checks = analysis.get("compliance_summary", {})
-            
-            # Map for human-friendly reasons
-            reasons = {
-                "patient_name": "Patient name is missing. A valid medical report must clearly identify the patient.",
-                "date": "Report date is missing. The document must clearly specify when it was issued.",
-                "medication": "No medications identified. This system requires a prescription list for analysis.",
-                "physician_signature": "Doctor signature or authentication details are missing."
-            }
-
-            # Generate the numbered list exactly as requested
-            fail_count = 1
-            for key, msg in reasons.items():
-                if checks.get(key) == "Missing":
-                    st.markdown(f"{fail_count}. {msg}")
-                    fail_count += 1
-
-            # Visual Details
-            st.write("---")
-            st.subheader("Validation Details")
-            cols = st.columns(4)
-            labels = {"patient_name": "Name", "date": "Date", "medication": "Meds", "physician_signature": "Signature"}
-            for i, (key, label) in enumerate(labels.items()):
-                status = checks.get(key, "Missing")
-                if status == "Found": cols[i].success(f"✅ {label}")
-                else: cols[i].error(f"❌ {label}")
-            continue 
-
-        # --- IF DOCUMENT PASSED: STEP-BY-STEP MATTER ---
-        st.success("✅ Document Verified & Analyzed Successfully")
-
-        # STEP 1: PATIENT SUMMARY
-        st.markdown("<div class='step-header'>🧑 STEP 1: PATIENT SUMMARY</div>", unsafe_allow_html=True)
-        p_data = analysis.get("patient_data", {})
-        s_data = analysis.get("summary_for_human", "No summary available.")
-        d_data = analysis.get("disease_explanation", "No disease explanation available.")
-        h_data = analysis.get("hospital_guide", "No hospital guide available.")
-
-        st.markdown(f"""
-        <div class='clinical-text'>
-        <b>Patient:</b> {p_data.get('patient_name')} | <b>Age:</b> {p_data.get('patient_age')} | <b>Sex:</b> {p_data.get('patient_sex')}<br><br>
-        {s_data}
-        </div>
-        """, unsafe_allow_html=True)
-
-        # STEP 2: DIAGNOSIS EXPLANATION
-        st.markdown("<div class='step-header'>🩺 STEP 2: DIAGNOSIS EXPLANATION</div>", unsafe_allow_html=True)
-        st.markdown(f"<div class='clinical-text'>{d_data}</div>", unsafe_allow_html=True)
-
-        # STEP 3: MEDICATION INFO
-        st.markdown("<div class='step-header'>💊 STEP 3: MEDICATION INFO</div>", unsafe_allow_html=True)
-        meds = analysis.get("medication_info", [])
-        if meds:
-            for med in meds:
-                st.markdown(f"<div class='clinical-text'>• {med}</div>", unsafe_allow_html=True)
-        else:
-            st.markdown("<div class='clinical-text'>No medications found.</div>", unsafe_allow_html=True)
-
-        # STEP 4: HOSPITAL GUIDE & NEXT STEPS
-        st.markdown("<div class='step-header'>🏥 STEP 4: HOSPITAL GUIDE & NEXT STEPS</div>", unsafe_allow_html=True)
-        st.markdown(f"<div class='clinical-text'>{h_data}</div>", unsafe_allow_html=True)
+        # Upload limits are enforced by the API before any processing
+        if not response.ok:
+            st.error(f"❌ Upload Rejected: {response.json().get('detail', response.reason)}")
+            st.stop()
+
+        # Results stream back as NDJSON, one line per file as soon as it's done
+        results = []
+        with st.spinner("🔍 Running Strict Compliance Audit..."):
+            try:
+                for line in response.iter_lines():
+                    if line:
+                        item = json.loads(line)
+                        render_result(item)
+                        results.append(item)
+            except Exception as e:
+                st.error(f"❌ Connection Failed: {str(e)}")
+                st.stop()
+
+        st.session_state["results"] = results
+        st.session_state["results_key"] = batch_key
+    else:
+        for item in st.session_state["results"]:
+            render_result(item)
 
 # Footer
 st.markdown("---")
@@ -1,19 +1,29 @@
 import os
+import io
+import asyncio
 import base64
-import json
-import re
-from typing import Dict, Any
+from typing import Dict, Any, Iterator, List, Optional, Tuple, Union
 
 from dotenv import load_dotenv
-from openai import OpenAI, APIStatusError
+import orjson
+from openai import AsyncOpenAI, APIStatusError
+from PIL import Image, ImageOps
 
-from src.textextraction import extract_text_from_image
+from src.textextraction import extract_text_from_image_async
 from src.pdfconverter import pdf_to_images # Integrated PDF conversion logic
-from src.config import VISION_MODEL_NAME
+from src.llm_cache import LLMCache
+from src.precheck import quick_compliance_precheck
+from src.config import (
+    VISION_MODEL_NAME,
+    LLM_IMAGE_MAX_SIDE,
+    LLM_IMAGE_JPEG_QUALITY,
+    ATTACH_PDF_PAGE_IMAGES,
+    LLM_BATCH_SIZE,
+)
 
 load_dotenv()
 
-client = OpenAI(
+client = AsyncOpenAI(
     base_url="https://openrouter.ai/api/v1",
     api_key=os.getenv("OPENAI_API_KEY")
 )
@@ -111,85 +121,285 @@ If VALID:
 Return STRICT JSON only.
 """
 
-def image_to_base64(path: str) -> str:
-    """Converts image to base64 string for Vision API."""
-    with open(path, "rb") as file:
-        return base64.b64encode(file.read()).decode()
+def _encode_image_for_llm(path_or_bytes: Union[str, bytes]) -> str:
+    """
+    Downscales an image to the model's useful resolution and re-encodes it
+    as JPEG base64 for the Vision API (far fewer bytes and vision tokens).
+    EXIF orientation is applied to the pixels first, since the re-encode
+    drops the tag and phone photos would otherwise arrive sideways.
+    """
+    source = io.BytesIO(path_or_bytes) if isinstance(path_or_bytes, bytes) else path_or_bytes
+    with Image.open(source) as original:
+        img = ImageOps.exif_transpose(original)
+        img.thumbnail((LLM_IMAGE_MAX_SIDE, LLM_IMAGE_MAX_SIDE), Image.LANCZOS)
+        buf = io.BytesIO()
+        img.convert("RGB").save(buf, format="JPEG", quality=LLM_IMAGE_JPEG_QUALITY, optimize=True)
+    return base64.b64encode(buf.getvalue()).decode("ascii")
+
+_BRACKET_PAIRS = {"{": "}", "[": "]"}
+
+def _iter_json_blocks(text: str) -> Iterator[str]:
+    """
+    Yields each balanced top-level {...} or [...] block in order.
+    Single linear pass that skips brackets inside JSON strings, so malformed
+    model output can't trigger regex backtracking.
+    """
+    closers: List[str] = []
+    start = 0
+    in_string = False
+    escaped = False
+
+    for index, char in enumerate(text):
+        if not closers:
+            if char in _BRACKET_PAIRS:
+                start = index
+                closers.append(_BRACKET_PAIRS[char])
+            continue
+
+        if in_string:
+            if escaped:
+                escaped = False
+            elif char == "\\":
+                escaped = True
+            elif char == '"':
+                in_string = False
+        elif char == '"':
+            in_string = True
+        elif char in _BRACKET_PAIRS:
+            closers.append(_BRACKET_PAIRS[char])
+        elif char in "}]":
+            if char != closers.pop():
+                # Mismatched bracket: abandon this candidate and keep scanning
+                closers.clear()
+            elif not closers:
+                yield text[start:index + 1]
 
-def extract_json_from_text(text: str) -> Dict[str, Any]:
-    """Parses JSON from raw model output using regex to find the JSON block."""
+def extract_json_from_text(text: str, expected: type = dict) -> Any:
+    """
+    Parses JSON from raw model output: the first block that decodes to the
+    expected type (dict for one document, list for a batch). Blocks of other
+    types, like a "[1]" citation before the object, are skipped.
+    """
+    for block in _iter_json_blocks(text):
+        try:
+            parsed = orjson.loads(block)
+        except orjson.JSONDecodeError:
+            continue
+        if isinstance(parsed, expected):
+            return parsed
     try:
-        match = re.search(r"(\{.*\}|\[.*\])", text, re.DOTALL)
-        if match:
-            return json.loads(match.group())
-        return json.loads(text)
+        parsed = orjson.loads(text)
     except Exception:
         raise ValueError("Invalid JSON from model")
+    if not isinstance(parsed, expected):
+        raise ValueError("Invalid JSON from model")
+    return parsed
 
-async def classify_document(file_path: str) -> Dict[str, Any]:
+# --------------------------------------------------
+# BATCH MODE ADDENDUM (several documents, one call)
+# --------------------------------------------------
+BATCH_PROMPT = """
+**BATCH MODE:**
+You will receive several documents. Each one starts with a <<FILE n>> marker,
+followed by its extracted text and then its page images.
+Analyze every FILE independently and never mix information between files.
+Return a JSON array with one object per FILE in order, each object following the OUTPUT FORMAT above
+plus a "file" field holding that FILE's number n, e.g. {"file": 1, "document_status": ...}.
+"""
+
+# Cached analyses are only valid for the prompts that produced them
+llm_cache = LLMCache(prompt=PROMPT + BATCH_PROMPT)
+
+
+def _match_batch(batch: Any, count: int) -> Optional[List[Dict[str, Any]]]:
     """
-    Main handler for analyzing both Image and PDF files.
-    Consolidates text extraction and multimodal visual analysis.
+    Orders batch results by the FILE number each object echoes back. Returns
+    None unless every FILE 1..count appears exactly once, so an analysis is
+    never assigned to the wrong document.
     """
-    # Step 1: Extract text asynchronously (All pages of PDF or Image)
-    ocr_text = extract_text_from_image(file_path)
-    
-    # Prepare multimodal message
-    messages = [
-        {
-            "role": "user",
-            "content": [
-                {
-                    "type": "text",
-                    "text": PROMPT + "\n\nEXTRACTED DOCUMENT TEXT:\n" + ocr_text
-                }
-            ]
-        }
-    ]
+    if not isinstance(batch, list) or len(batch) != count:
+        return None
+    by_number: Dict[int, Dict[str, Any]] = {}
+    for result in batch:
+        if not isinstance(result, dict):
+            return None
+        number = result.pop("file", None)
+        try:
+            number = int(number)
+        except (TypeError, ValueError):
+            return None
+        if number in by_number or not 1 <= number <= count:
+            return None
+        by_number[number] = result
+    return [by_number[number] for number in range(1, count + 1)]
 
-    # Step 2: Add visual context
-    if file_path.lower().endswith(".pdf"):
-        # NEW LOGIC: Convert PDF pages to images so Vision LLM can scan multi-page visuals
-        folder_name = pdf_to_images(file_path)
-        image_dir = os.path.join("uploads/images", folder_name)
-        
-        # Loop through each page image and add it to the message
-        for image_name in sorted(os.listdir(image_dir)):
-            image_path = os.path.join(image_dir, image_name)
-            base64_image = image_to_base64(image_path)
-            messages[0]["content"].append({
-                "type": "image_url",
-                "image_url": {"url": f"data:image/png;base64,{base64_image}"}
-            })
-    else:
-        # Standard logic for single image uploads
-        image_base64 = image_to_base64(file_path)
-        messages[0]["content"].append({
-            "type": "image_url",
-            "image_url": {"url": f"data:image/png;base64,{image_base64}"}
-        })
-
-    # Step 3: Call AI Model
+def _failed_parse_result() -> Dict[str, Any]:
+    return {
+        "document_status": "FAILED",
+        "failure_reason": "Model output parsing failed. The document structure could not be verified."
+    }
+
+def _image_block(base64_image: str) -> Dict[str, Any]:
+    return {
+        "type": "image_url",
+        "image_url": {"url": f"data:image/jpeg;base64,{base64_image}"}
+    }
+
+async def _image_sources(file_path: str) -> List[Union[str, bytes]]:
+    """Image sources to attach for a file: its own path, or rendered PDF pages as PNG bytes."""
+    if not file_path.lower().endswith(".pdf"):
+        return [file_path]
+    if not ATTACH_PDF_PAGE_IMAGES:
+        return []
+
+    # NEW LOGIC: PDF pages rendered to images so Vision LLM can scan multi-page visuals.
+    # Page PNGs are rendered in memory only, so the PDF path never touches the filesystem.
+    _, page_images = await asyncio.to_thread(
+        pdf_to_images, file_path, return_bytes=True, save_images=False
+    )
+    return page_images
+
+async def _extract_document(file_path: str) -> Tuple[str, List[Union[str, bytes]]]:
+    """
+    Runs OCR and, for PDFs, page rasterization concurrently, so latency is
+    max(ocr, rasterize) rather than the sum.
+    """
+    ocr_text, sources = await asyncio.gather(
+        extract_text_from_image_async(file_path),
+        _image_sources(file_path)
+    )
+    return ocr_text, sources
+
+async def _encode_images(sources: List[Union[str, bytes]]) -> List[str]:
+    """Encodes images in parallel worker threads (Pillow releases the GIL)."""
+    return await asyncio.gather(
+        *[asyncio.to_thread(_encode_image_for_llm, source) for source in sources]
+    )
+
+async def _call_model(content: List[Dict[str, Any]]) -> str:
+    """Sends one multimodal user message and returns the raw model text."""
     if not os.getenv("OPENAI_API_KEY"):
         raise RuntimeError("OPENAI_API_KEY is missing in environment.")
 
     try:
-        response = client.chat.completions.create(
+        response = await client.chat.completions.create(
             model=VISION_MODEL_NAME,
             temperature=0.1,
-            messages=messages
+            messages=[{"role": "user", "content": content}]
         )
     except APIStatusError as exc:
         status = getattr(exc, "status_code", "unknown")
         raise RuntimeError(f"Model API error ({status}): {str(exc)}") from exc
 
-    raw_output = response.choices[0].message.content.strip()
+    return response.choices[0].message.content.strip()
+
+async def _early_result(ocr_text: str) -> Optional[Dict[str, Any]]:
+    """Result available without an LLM call: precheck failure or cached analysis."""
+    # Clearly non-compliant text fails without an LLM round-trip
+    precheck = quick_compliance_precheck(ocr_text)
+    if precheck is not None:
+        return precheck
+
+    # Re-uploads of an already analyzed document skip the LLM entirely
+    return await asyncio.to_thread(llm_cache.get, ocr_text)
+
+async def _classify_extracted(ocr_text: str, sources: List[Union[str, bytes]]) -> Dict[str, Any]:
+    """Single-document LLM analysis for already extracted text and images."""
+    early = await _early_result(ocr_text)
+    if early is not None:
+        return early
+
+    # Multimodal message: static PROMPT first (marked cacheable so the
+    # provider reuses its tokenized prefix across documents), dynamic text next,
+    # images last
+    content: List[Dict[str, Any]] = [
+        {"type": "text", "text": PROMPT, "cache_control": {"type": "ephemeral"}},
+        {"type": "text", "text": "EXTRACTED DOCUMENT TEXT:\n" + ocr_text},
+    ]
+    content.extend(_image_block(image) for image in await _encode_images(sources))
+
+    raw_output = await _call_model(content)
 
-    # Step 4: Parse Result
     try:
-        return extract_json_from_text(raw_output)
+        result = extract_json_from_text(raw_output)
     except Exception:
-        return {
-            "document_status": "FAILED",
-            "failure_reason": "Model output parsing failed. The document structure could not be verified."
-        }
\ No newline at end of file
+        return _failed_parse_result()
+
+    await asyncio.to_thread(llm_cache.set, ocr_text, result)
+    return result
+
+async def classify_document(file_path: str) -> Dict[str, Any]:
+    """
+    Main handler for analyzing both Image and PDF files.
+    Consolidates text extraction and multimodal visual analysis.
+    """
+    ocr_text, sources = await _extract_document(file_path)
+    return await _classify_extracted(ocr_text, sources)
+
+async def classify_documents_batch(
+    paths: List[str],
+    max_batch: int = LLM_BATCH_SIZE,
+    ocr_texts: Optional[List[str]] = None
+) -> List[Dict[str, Any]]:
+    """
+    Analyzes several documents with one LLM call per group of max_batch files.
+    Pass ocr_texts when OCR already ran; otherwise it runs here. Results are
+    returned in the order of paths. Results are matched to files by the FILE
+    number the model echoes; on any mismatch each file is re-sent on its own.
+    """
+    if ocr_texts is None:
+        ocr_texts = await asyncio.gather(*[extract_text_from_image_async(path) for path in paths])
+
+    if len(paths) > max_batch:
+        groups = await asyncio.gather(*[
+            classify_documents_batch(paths[i:i + max_batch], max_batch, ocr_texts[i:i + max_batch])
+            for i in range(0, len(paths), max_batch)
+        ])
+        return [result for group in groups for result in group]
+
+    results: List[Optional[Dict[str, Any]]] = list(
+        await asyncio.gather(*[_early_result(ocr_text) for ocr_text in ocr_texts])
+    )
+    pending = [index for index, result in enumerate(results) if result is None]
+
+    # Only files that actually reach the LLM get rasterized
+    sources = await asyncio.gather(*[_image_sources(paths[index]) for index in pending])
+
+    if len(pending) == 1:
+        index = pending[0]
+        results[index] = await _classify_extracted(ocr_texts[index], sources[0])
+    elif pending:
+        content: List[Dict[str, Any]] = [
+            {"type": "text", "text": PROMPT, "cache_control": {"type": "ephemeral"}},
+            {"type": "text", "text": BATCH_PROMPT},
+        ]
+        encoded = await asyncio.gather(*[_encode_images(images) for images in sources])
+        for number, (index, images) in enumerate(zip(pending, encoded), start=1):
+            content.append({
+                "type": "text",
+                "text": f"<<FILE {number}>>\nEXTRACTED DOCUMENT TEXT:\n" + ocr_texts[index]
+            })
+            content.extend(_image_block(image) for image in images)
+
+        raw_output = await _call_model(content)
+        try:
+            batch = _match_batch(extract_json_from_text(raw_output, expected=list), len(pending))
+        except Exception:
+            batch = None
+
+        if batch is not None:
+            await asyncio.gather(*[
+                asyncio.to_thread(llm_cache.set, ocr_texts[index], result)
+                for index, result in zip(pending, batch)
+            ])
+            for index, result in zip(pending, batch):
+                results[index] = result
+        else:
+            singles = await asyncio.gather(*[
+                _classify_extracted(ocr_texts[index], images)
+                for index, images in zip(pending, sources)
+            ])
+            for index, result in zip(pending, singles):
+                results[index] = result
+
+    return results
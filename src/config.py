@@ -1,8 +1,39 @@
 import os
 
+# Root log level for the API process
+LOG_LEVEL: str = os.getenv("LOG_LEVEL", "INFO")
+
 # Maximum number of concurrent OCR requests
 MAX_CONCURRENT_OCR: int = 5
 
+# Default thread pool for asyncio.to_thread work (uploads, hashing, rendering, encoding)
+OCR_THREAD_POOL: int = int(os.getenv("OCR_THREAD_POOL", str(max(32, MAX_CONCURRENT_OCR * 4))))
+
+# LlamaParse request pacing and retry policy (429 / 5xx)
+LLAMA_RPS: float = float(os.getenv("LLAMA_RPS", "2"))
+LLAMA_MAX_RETRIES: int = int(os.getenv("LLAMA_MAX_RETRIES", "5"))
+LLAMA_BACKOFF_BASE_S: float = 1.0
+LLAMA_BACKOFF_CAP_S: float = 30.0
+
+# Upper bound on a single LlamaParse request (one attempt; retries get a fresh budget)
+OCR_TIMEOUT_S: float = float(os.getenv("OCR_TIMEOUT_S", "120"))
+
+# Images are OCR'd locally with Tesseract first (LlamaParse on empty output or error)
+LOCAL_IMAGE_OCR: bool = os.getenv("LOCAL_IMAGE_OCR", "true").lower() in {"1", "true", "yes"}
+OCR_CONCURRENCY: int = int(os.getenv("OCR_CONCURRENCY", str(os.cpu_count() or 1)))
+# Mean Tesseract word confidence (0-100) below which LlamaParse is used instead
+LOCAL_OCR_MIN_CONFIDENCE: float = float(os.getenv("LOCAL_OCR_MIN_CONFIDENCE", "80"))
+
+# Circuit breaker: after this many consecutive LlamaParse failures, skip OCR for the cool-down
+OCR_BREAKER_THRESHOLD: int = 5
+OCR_BREAKER_COOLDOWN_S: float = 30.0
+
+# Multi-page PDFs are OCR'd as single-page jobs in chunks of this many pages
+PAGES_PER_BATCH: int = int(os.getenv("PAGES_PER_BATCH", "16"))
+
+# Persistent OCR text cache (keyed on file content hash)
+OCR_CACHE_PATH: str = "uploads/ocr_cache.sqlite"
+
 # Vision LLM model name (OpenRouter)
 VISION_MODEL_NAME: str = os.getenv(
     "VISION_MODEL_NAME",
@@ -10,10 +41,27 @@ VISION_MODEL_NAME: str = os.getenv(
 )
 
 
+# Vision LLM result cache (keyed on OCR text)
+LLM_CACHE_DIR: str = "uploads/llm_cache"
+LLM_CACHE_TTL_SECONDS: int = int(os.getenv("LLM_CACHE_TTL_SECONDS", str(7 * 24 * 3600)))
+
+
+# Multi-document LLM batching: files per call and image budget per call
+LLM_BATCH_SIZE: int = 3
+LLM_BATCH_MAX_IMAGES: int = 8
+
+
 # PDF to image conversion settings
-PDF_IMAGE_DPI: int = 302
+PDF_IMAGE_DPI: int = 200
 PDF_IMAGE_BASE_DIR: str = "uploads/images"
 
+# Send rendered PDF pages to the Vision LLM alongside the OCR text
+ATTACH_PDF_PAGE_IMAGES: bool = os.getenv("ATTACH_PDF_PAGE_IMAGES", "true").lower() in {"1", "true", "yes"}
+
+# Images sent to the Vision LLM (downscaled + JPEG re-encoded)
+LLM_IMAGE_MAX_SIDE: int = 1536
+LLM_IMAGE_JPEG_QUALITY: int = 85
+
 
 # file upload limitations
 
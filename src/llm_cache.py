@@ -0,0 +1,89 @@
+import os
+import json
+import time
+import tempfile
+import hashlib
+from typing import Dict, Any, Optional
+
+from src.config import VISION_MODEL_NAME, LLM_CACHE_DIR, LLM_CACHE_TTL_SECONDS
+
+
+# --------------------------------------------------
+# LLM RESULT CACHE
+# --------------------------------------------------
+class LLMCache:
+    """
+    On-disk cache for Vision LLM results keyed on the OCR text.
+
+    Each entry is stored as a JSON file named after
+    sha256(model name + prompt hash + normalized OCR text),
+    so re-uploads of the same document skip the LLM round-trip
+    and any prompt edit starts a fresh set of keys. Methods do
+    blocking file I/O; call them from a worker thread in async code.
+    """
+
+    def __init__(
+        self,
+        cache_dir: Optional[str] = None,
+        ttl_seconds: Optional[int] = None,
+        prompt: str = ""
+    ) -> None:
+        self.cache_dir: str = cache_dir or LLM_CACHE_DIR
+        self.ttl_seconds: int = LLM_CACHE_TTL_SECONDS if ttl_seconds is None else ttl_seconds
+        self.prompt_hash: str = hashlib.sha256(prompt.encode("utf-8")).hexdigest()
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+    @staticmethod
+    def _normalize(text: str) -> str:
+        """Collapses whitespace so OCR layout noise doesn't change the key."""
+        return " ".join(text.split())
+
+    def _key(self, ocr_text: str) -> str:
+        payload = VISION_MODEL_NAME + self.prompt_hash + self._normalize(ocr_text)
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.cache_dir, f"{key}.json")
+
+    def get(self, ocr_text: str) -> Optional[Dict[str, Any]]:
+        """Returns the cached result for this OCR text, or None on miss/expiry."""
+        if not ocr_text.strip():
+            return None
+
+        path = self._path(self._key(ocr_text))
+        try:
+            with open(path, "r", encoding="utf-8") as file:
+                entry = json.load(file)
+        except (OSError, ValueError):
+            return None
+
+        if time.time() - entry.get("created_at", 0) > self.ttl_seconds:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            return None
+
+        return entry.get("result")
+
+    def set(self, ocr_text: str, result: Dict[str, Any]) -> None:
+        """Stores a result; written to a temp file first so readers never see partial JSON."""
+        if not ocr_text.strip():
+            return
+
+        path = self._path(self._key(ocr_text))
+        tmp_path: Optional[str] = None
+        try:
+            # Unique temp file per call: concurrent writers (threads included)
+            # of the same key never share one
+            fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir, suffix=".tmp")
+            with os.fdopen(fd, "w", encoding="utf-8") as file:
+                json.dump({"created_at": time.time(), "result": result}, file)
+            os.replace(tmp_path, path)
+        except OSError:
+            # Caching is best-effort; never fail the analysis because of it
+            if tmp_path is not None:
+                try:
+                    os.remove(tmp_path)
+                except OSError:
+                    pass
@@ -1,12 +1,71 @@
-from fastapi import FastAPI, UploadFile, File
-from fastapi.responses import JSONResponse
+from fastapi import FastAPI, UploadFile, File, HTTPException
+from fastapi.responses import StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
-from typing import List, Dict, Any
+from typing import List, Dict, Any, Optional, Set, Tuple, Union
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+from logging.handlers import QueueHandler, QueueListener
 import asyncio
+import logging
+import queue
 import os
-from src.analysis import classify_document
+import shutil
+import tempfile
+from pathlib import Path
+import orjson
+from src.analysis import classify_documents_batch
+from src.precheck import quick_compliance_precheck
+from src.textextraction import cached_text, extract_text_from_image_async, warm_up
+from src.pdfconverter import pdf_page_count, shutdown_pool
+from src.config import (
+    ALLOWED_EXTENSIONS,
+    MAX_TOTAL_FILES,
+    MAX_PDFS,
+    MAX_IMAGES,
+    MAX_IMAGE_MB,
+    MAX_PDF_MB,
+    LLM_BATCH_SIZE,
+    LLM_BATCH_MAX_IMAGES,
+    ATTACH_PDF_PAGE_IMAGES,
+    OCR_THREAD_POOL,
+    LOG_LEVEL,
+)
+
+
+def _configure_logging() -> QueueListener:
+    """
+    Routes all log records through a queue so request handlers only enqueue;
+    a background listener thread does the formatting and stream writes.
+    """
+    handler = logging.StreamHandler()
+    handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(name)s: %(message)s"))
+
+    log_queue: "queue.SimpleQueue[logging.LogRecord]" = queue.SimpleQueue()
+    root = logging.getLogger()
+    root.setLevel(LOG_LEVEL)
+    root.addHandler(QueueHandler(log_queue))
+
+    return QueueListener(log_queue, handler)
+
 
-app = FastAPI(title="Medical Document Analysis API")
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # asyncio.to_thread uses the loop's default executor, which the stdlib
+    # caps at min(32, cpu_count + 4); size it for blocking I/O-heavy work
+    executor = ThreadPoolExecutor(max_workers=OCR_THREAD_POOL, thread_name_prefix="ocr")
+    asyncio.get_running_loop().set_default_executor(executor)
+    listener = _configure_logging()
+    listener.start()
+    # Pre-open LlamaParse connections in the background; startup doesn't wait
+    warm_up_task = asyncio.create_task(warm_up())
+    yield
+    warm_up_task.cancel()
+    await asyncio.to_thread(shutdown_pool)
+    listener.stop()
+    executor.shutdown(wait=False)
+
+
+app = FastAPI(title="Medical Document Analysis API", lifespan=lifespan)
 
 # ✅ CORS CONFIGURATION (IMPORTANT)
 app.add_middleware(
@@ -21,32 +80,220 @@ UPLOAD_DIR = "uploads"
 os.makedirs(UPLOAD_DIR, exist_ok=True)
 
 
+def _upload_size(file: UploadFile) -> int:
+    """Size of an upload without reading it (falls back to seeking the spooled file)."""
+    if file.size is not None:
+        return file.size
+    position = file.file.tell()
+    file.file.seek(0, os.SEEK_END)
+    size = file.file.tell()
+    file.file.seek(position)
+    return size
+
+
+def _validate_uploads(files: List[UploadFile]) -> None:
+    """Rejects the batch before any disk/OCR work if it breaks the upload limits."""
+    if len(files) > MAX_TOTAL_FILES:
+        raise HTTPException(status_code=413, detail=f"Too many files: {len(files)} (max {MAX_TOTAL_FILES}).")
+
+    pdf_count = 0
+    image_count = 0
+    for file in files:
+        ext = Path(file.filename or "").suffix.lower()
+        if ext not in ALLOWED_EXTENSIONS:
+            raise HTTPException(status_code=415, detail=f"Unsupported file type: {file.filename}")
+
+        if ext == ".pdf":
+            pdf_count += 1
+            limit_mb = MAX_PDF_MB
+        else:
+            image_count += 1
+            limit_mb = MAX_IMAGE_MB
+
+        if _upload_size(file) > limit_mb * 1024 * 1024:
+            raise HTTPException(status_code=413, detail=f"{file.filename} exceeds the {limit_mb} MB limit.")
+
+    if pdf_count > MAX_PDFS:
+        raise HTTPException(status_code=413, detail=f"Too many PDFs: {pdf_count} (max {MAX_PDFS}).")
+    if image_count > MAX_IMAGES:
+        raise HTTPException(status_code=413, detail=f"Too many images: {image_count} (max {MAX_IMAGES}).")
+
+
+def _image_count(path: str) -> int:
+    """How many images a file contributes to an LLM call."""
+    if not path.lower().endswith(".pdf"):
+        return 1
+    if not ATTACH_PDF_PAGE_IMAGES:
+        return 0
+    try:
+        return pdf_page_count(path)
+    except Exception:
+        # Unreadable PDFs go in their own group so they can't sink a batch
+        return LLM_BATCH_MAX_IMAGES + 1
+
+
+class _BatchPlanner:
+    """
+    Groups file indexes for batched LLM calls as the files become ready: same
+    extension tier (PDF vs image), at most LLM_BATCH_SIZE files and
+    LLM_BATCH_MAX_IMAGES images per group. add() returns the groups that
+    filled up; flush() returns whatever is still open. image_counts come from
+    _image_count, computed off the event loop since it opens PDFs.
+    """
+
+    def __init__(self, paths: List[str], image_counts: List[int]) -> None:
+        self.paths: List[str] = paths
+        self.image_counts: List[int] = image_counts
+        self._open: Dict[bool, List[int]] = {True: [], False: []}
+        self._images: Dict[bool, int] = {True: 0, False: 0}
+
+    def _close(self, is_pdf: bool) -> List[int]:
+        group = self._open[is_pdf]
+        self._open[is_pdf], self._images[is_pdf] = [], 0
+        return group
+
+    def add(self, index: int) -> List[List[int]]:
+        is_pdf = self.paths[index].lower().endswith(".pdf")
+        images = self.image_counts[index]
+        ready: List[List[int]] = []
+        if self._open[is_pdf] and self._images[is_pdf] + images > LLM_BATCH_MAX_IMAGES:
+            ready.append(self._close(is_pdf))
+        self._open[is_pdf].append(index)
+        self._images[is_pdf] += images
+        if len(self._open[is_pdf]) >= LLM_BATCH_SIZE or self._images[is_pdf] >= LLM_BATCH_MAX_IMAGES:
+            ready.append(self._close(is_pdf))
+        return ready
+
+    def flush(self) -> List[List[int]]:
+        return [self._close(is_pdf) for is_pdf in (True, False) if self._open[is_pdf]]
+
+
+def _copy_upload(file: UploadFile, path: str) -> None:
+    file.file.seek(0)
+    with open(path, "wb") as out:
+        shutil.copyfileobj(file.file, out, length=1 << 20)
+
+
 @app.post("/analyze")
 async def analyze(files: List[UploadFile] = File(...)):
+    _validate_uploads(files)
 
-    async def process(file: UploadFile) -> Dict[str, Any]:
-        path = os.path.join(UPLOAD_DIR, file.filename)
+    def item(index: int, analysis: Dict[str, Any]) -> Dict[str, Any]:
+        return {"file": files[index].filename, "analysis": analysis}
 
-        contents = await file.read()
-        with open(path, "wb") as f:
-            f.write(contents)
+    def system_error(index: int, e: Exception) -> Dict[str, Any]:
+        return item(index, {
+            "document_status": "FAILED",
+            "failure_reason": f"System Error: {str(e)}"
+        })
 
+    async def save_and_lookup(index: int, file: UploadFile) -> Tuple[str, Optional[str], int]:
+        # Index-prefixed inside this request's own directory, so uploads that
+        # share a filename (in this request or a concurrent one) never collide
+        path = os.path.join(request_dir, f"{index}_{os.path.basename(file.filename)}")
+
+        # Copy straight from the spooled temp file in a worker thread:
+        # no Python-level bytes copy of the upload, and the loop stays free
+        await asyncio.to_thread(_copy_upload, file, path)
+
+        text, images = await asyncio.gather(
+            asyncio.to_thread(cached_text, path),
+            asyncio.to_thread(_image_count, path)
+        )
+        return path, text, images
+
+    async def process(group: List[int]) -> List[Dict[str, Any]]:
         try:
-            result = await classify_document(path)
+            analyses = await classify_documents_batch(
+                [paths[i] for i in group],
+                ocr_texts=[ocr_texts[i] for i in group]
+            )
+            return [item(i, analysis) for i, analysis in zip(group, analyses)]
 
-            return {
-                "file": file.filename,
-                "analysis": result
-            }
+        except Exception as e:
+            return [system_error(i, e) for i in group]
 
+    async def ocr(index: int) -> Tuple[int, Union[str, Exception]]:
+        # A failure is returned, not raised, so it only fails this file's item
+        try:
+            return index, await extract_text_from_image_async(paths[index])
         except Exception as e:
-            return {
-                "file": file.filename,
-                "analysis": {
-                    "document_status": "FAILED",
-                    "failure_reason": f"System Error: {str(e)}"
-                }
-            }
-
-    results = await asyncio.gather(*[process(f) for f in files])
-    return JSONResponse(content=results)
\ No newline at end of file
+            return index, e
+
+    async def stream():
+        try:
+            async for line in stream_results():
+                yield line
+        finally:
+            # Uploads are only needed while their results are produced; the OCR
+            # and LLM caches are keyed on content, not on these paths
+            await asyncio.to_thread(shutil.rmtree, request_dir, True)
+
+    async def stream_results():
+        planner = _BatchPlanner(paths, image_counts)
+        running: Set[asyncio.Task] = set()
+        ocr_tasks: Set[asyncio.Task] = set()
+
+        def launch(groups: List[List[int]]) -> None:
+            running.update(asyncio.create_task(process(group)) for group in groups)
+
+        try:
+            # Cache hits are judged and sent to the LLM right away, so they
+            # never wait for the slowest OCR miss
+            for i, text in enumerate(ocr_texts):
+                if text is None:
+                    ocr_tasks.add(asyncio.create_task(ocr(i)))
+                    continue
+                precheck = quick_compliance_precheck(text)
+                if precheck is not None:
+                    yield orjson.dumps(item(i, precheck)) + b"\n"
+                else:
+                    launch(planner.add(i))
+            launch(planner.flush())
+            running.update(ocr_tasks)
+
+            # Misses join LLM groups as their OCR finishes; a group is sent
+            # once full, and the remainder once the last OCR is done. Clearly
+            # non-compliant files are reported as soon as their text is known
+            while running:
+                done, _ = await asyncio.wait(running, return_when=asyncio.FIRST_COMPLETED)
+                running.difference_update(done)
+                for task in done:
+                    if task not in ocr_tasks:
+                        for entry in task.result():
+                            yield orjson.dumps(entry) + b"\n"
+                        continue
+
+                    ocr_tasks.discard(task)
+                    i, text = task.result()
+                    if isinstance(text, Exception):
+                        yield orjson.dumps(system_error(i, text)) + b"\n"
+                    else:
+                        ocr_texts[i] = text
+                        precheck = quick_compliance_precheck(text)
+                        if precheck is not None:
+                            yield orjson.dumps(item(i, precheck)) + b"\n"
+                        else:
+                            launch(planner.add(i))
+                    if not ocr_tasks:
+                        launch(planner.flush())
+        finally:
+            # Client went away: stop outstanding OCR and LLM work
+            for task in running:
+                task.cancel()
+
+    # Phase 1: write uploads, hash them, look up cached OCR text and count the
+    # images each file adds to an LLM call. Done before responding since the
+    # upload files are closed once the endpoint returns
+    request_dir = tempfile.mkdtemp(prefix="request_", dir=UPLOAD_DIR)
+    try:
+        saved = await asyncio.gather(*[save_and_lookup(i, f) for i, f in enumerate(files)])
+    except BaseException:
+        await asyncio.to_thread(shutil.rmtree, request_dir, True)
+        raise
+    paths = [path for path, _, _ in saved]
+    ocr_texts: List[Optional[str]] = [text for _, text, _ in saved]
+    image_counts = [images for _, _, images in saved]
+
+    # One NDJSON line per file, in completion order
+    return StreamingResponse(stream(), media_type="application/x-ndjson")
@@ -0,0 +1,64 @@
+import os
+import sqlite3
+import hashlib
+from pathlib import Path
+from typing import Optional
+
+from src.config import OCR_CACHE_PATH
+
+
+# --------------------------------------------------
+# OCR TEXT CACHE
+# --------------------------------------------------
+# Persistent map from file content digest to extracted OCR text, so
+# re-uploading the same document never pays for LlamaParse twice.
+
+_SCHEMA = "CREATE TABLE IF NOT EXISTS ocr_cache (digest TEXT PRIMARY KEY, text TEXT NOT NULL)"
+
+
+def _connect() -> sqlite3.Connection:
+    os.makedirs(os.path.dirname(OCR_CACHE_PATH) or ".", exist_ok=True)
+    conn = sqlite3.connect(OCR_CACHE_PATH, timeout=10)
+    conn.execute(_SCHEMA)
+    return conn
+
+
+def _new_hasher() -> hashlib.blake2b:
+    return hashlib.blake2b(digest_size=16)
+
+
+def file_digest(file_path: str) -> str:
+    """
+    Content key for a file: blake2b of its bytes, plus the size and
+    extension to make accidental collisions harmless. hashlib.file_digest
+    streams the file through a reused buffer (readinto, no per-chunk copies).
+    """
+    with open(file_path, "rb") as file:
+        hasher = hashlib.file_digest(file, _new_hasher)
+        size = os.fstat(file.fileno()).st_size
+    ext = Path(file_path).suffix.lower()
+    return f"{hasher.hexdigest()}-{size}{ext}"
+
+
+def get(digest: str) -> Optional[str]:
+    """Returns cached OCR text for this digest, or None on miss."""
+    try:
+        with _connect() as conn:
+            row = conn.execute(
+                "SELECT text FROM ocr_cache WHERE digest = ?", (digest,)
+            ).fetchone()
+    except sqlite3.Error:
+        return None
+    return row[0] if row else None
+
+
+def set(digest: str, text: str) -> None:
+    """Stores OCR text for this digest (best-effort; errors are ignored)."""
+    try:
+        with _connect() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO ocr_cache (digest, text) VALUES (?, ?)",
+                (digest, text)
+            )
+    except sqlite3.Error:
+        pass
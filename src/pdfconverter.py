@@ -1,22 +1,111 @@
 import os
-from typing import Optional
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
+from typing import List, Optional, Tuple, Union
 import fitz  # PyMuPDF
 from src.config import PDF_IMAGE_DPI, PDF_IMAGE_BASE_DIR
 
 
+# PyMuPDF is not thread-safe: every fitz call made in this process (page
+# counts, page splits, inline renders from asyncio.to_thread workers) holds
+# this lock. Pool workers are separate processes, so they never contend.
+_fitz_lock = threading.Lock()
+
+
+def _get_max_workers() -> int:
+    """Worker count for the shared render pool, capped by CPUs and 8."""
+    return max(1, min(os.cpu_count() or 1, 8))
+
+
+# One render pool per process, created on first use and shut down by the
+# API lifespan hook. Workers are spawned, not forked: forking the threaded
+# server is deadlock-prone, and a per-PDF pool paid start-up on every call.
+_pool: Optional[ProcessPoolExecutor] = None
+_pool_lock = threading.Lock()
+
+
+def _get_pool() -> ProcessPoolExecutor:
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ProcessPoolExecutor(
+                max_workers=_get_max_workers(),
+                mp_context=multiprocessing.get_context("spawn")
+            )
+        return _pool
+
+
+def _discard_pool(pool: ProcessPoolExecutor) -> None:
+    global _pool
+    with _pool_lock:
+        if _pool is pool:
+            _pool = None
+
+
+def shutdown_pool() -> None:
+    """Stops the shared render pool (a later render creates a new one)."""
+    global _pool
+    with _pool_lock:
+        pool, _pool = _pool, None
+    if pool is not None:
+        pool.shutdown(wait=True, cancel_futures=True)
+
+
+def _render_page(
+    pdf_path: str,
+    page_index: int,
+    output_dir: Optional[str],
+    dpi: int
+) -> bytes:
+    """
+    Render a single PDF page to PNG (runs in a worker process,
+    or inline for single-page PDFs).
+
+    Each worker opens its own document handle since PyMuPDF
+    documents cannot be shared across processes. The encoded
+    PNG is returned to the caller and, when output_dir is
+    given, also written to disk.
+    """
+    with _fitz_lock:
+        document = fitz.open(pdf_path)
+        try:
+            png_bytes = document[page_index].get_pixmap(dpi=dpi).tobytes("png")
+            if output_dir is not None:
+                image_path = os.path.join(output_dir, f"page_{page_index + 1}.png")
+                with open(image_path, "wb") as file:
+                    file.write(png_bytes)
+            return png_bytes
+        finally:
+            document.close()
+
+
+def pdf_page_count(pdf_path: str) -> int:
+    """Number of pages in a PDF (opens the file without rendering anything)."""
+    with _fitz_lock:
+        document = fitz.open(pdf_path)
+        try:
+            return document.page_count
+        finally:
+            document.close()
+
+
 # --------------------------------------------------
 # PDF TO IMAGE CONVERSION
 # --------------------------------------------------
 def pdf_to_images(
     pdf_path: str,
-    base_dir: Optional[str] = None
-) -> str:
+    base_dir: Optional[str] = None,
+    return_bytes: bool = False,
+    save_images: bool = True
+) -> Union[str, Tuple[str, List[bytes]]]:
     """
     Convert a multi-page PDF into individual PNG images.
 
-    Each page of the PDF is rendered at a fixed DPI and
-    saved as a separate image file inside a directory
-    named after the PDF.
+    Each page of the PDF is rendered at a fixed DPI in the
+    shared pool of worker processes and saved as a separate image
+    file inside a directory named after the PDF.
 
     Parameters
     ----------
@@ -25,12 +114,20 @@ def pdf_to_images(
     base_dir : str, optional
         Base directory where page images will be stored.
         Defaults to the configured PDF_IMAGE_BASE_DIR.
+    return_bytes : bool, optional
+        When True, also return the PNG-encoded pages in
+        page order so callers can skip reading them back.
+    save_images : bool, optional
+        When False, pages are only rendered in memory and
+        nothing is written under base_dir (only useful
+        together with return_bytes).
 
     Returns
     -------
-    str
+    str or tuple of (str, list of bytes)
         Name of the PDF file (without extension), used
-        as the output folder name.
+        as the output folder name, plus the page PNGs
+        when return_bytes is True.
     """
 
     # Resolve base output directory
@@ -39,21 +136,92 @@ def pdf_to_images(
     # Extract PDF name (without extension)
     pdf_name: str = os.path.splitext(os.path.basename(pdf_path))[0]
 
-    # Create output directory for this PDF
-    output_dir: str = os.path.join(output_base, pdf_name)
-    os.makedirs(output_dir, exist_ok=True)
-
-    # Open PDF document
-    document = fitz.open(pdf_path)
+    # Create output directory for this PDF (skipped for in-memory rendering)
+    output_dir: Optional[str] = None
+    if save_images:
+        output_dir = os.path.join(output_base, pdf_name)
+        os.makedirs(output_dir, exist_ok=True)
 
-    # Render each page as a high-resolution PNG image
-    for page_index, page in enumerate(document, start=1):
-        pixmap = page.get_pixmap(dpi=PDF_IMAGE_DPI)
-        pixmap.save(
-            os.path.join(output_dir, f"page_{page_index}.png")
-        )
+    # Open PDF once just to read the page count
+    page_count: int = pdf_page_count(pdf_path)
 
-    # Close document to release resources
-    document.close()
+    # Render pages in parallel; single-page PDFs skip the pool overhead
+    if page_count <= 1:
+        pages: List[bytes] = [
+            _render_page(pdf_path, page_index, output_dir, PDF_IMAGE_DPI)
+            for page_index in range(page_count)
+        ]
+    else:
+        pool = _get_pool()
+        futures = [
+            pool.submit(_render_page, pdf_path, page_index, output_dir, PDF_IMAGE_DPI)
+            for page_index in range(page_count)
+        ]
+        try:
+            # Surface the first rendering error immediately
+            for future in as_completed(futures):
+                future.result()
+        except BrokenProcessPool:
+            # A crashed worker breaks the pool for good; start over next call
+            _discard_pool(pool)
+            raise
+        except Exception:
+            for future in futures:
+                future.cancel()
+            raise
+        pages = [future.result() for future in futures]
 
+    if return_bytes:
+        return pdf_name, pages
     return pdf_name
+
+
+# --------------------------------------------------
+# PDF PAGE SPLITTING
+# --------------------------------------------------
+def split_pdf_pages(
+    pdf_path: str,
+    output_dir: str,
+    start: int = 0,
+    stop: Optional[int] = None
+) -> List[str]:
+    """
+    Write pages [start, stop) of a PDF as single-page PDFs.
+
+    Used to OCR long documents page by page so the pages
+    can be parsed concurrently instead of as one job.
+
+    Parameters
+    ----------
+    pdf_path : str
+        Path to the input PDF file.
+    output_dir : str
+        Existing directory the page files are written to.
+    start : int, optional
+        Index of the first page to write.
+    stop : int, optional
+        Index one past the last page; defaults to the end.
+
+    Returns
+    -------
+    list of str
+        Paths of the single-page PDFs, in page order.
+    """
+    pdf_name: str = os.path.splitext(os.path.basename(pdf_path))[0]
+    with _fitz_lock:
+        document = fitz.open(pdf_path)
+        try:
+            stop = document.page_count if stop is None else min(stop, document.page_count)
+            page_paths: List[str] = []
+            for page_index in range(start, stop):
+                page_document = fitz.open()
+                try:
+                    page_document.insert_pdf(document, from_page=page_index, to_page=page_index)
+                    page_path = os.path.join(output_dir, f"{pdf_name}_page_{page_index + 1}.pdf")
+                    page_document.save(page_path)
+                finally:
+                    page_document.close()
+                page_paths.append(page_path)
+            return page_paths
+        finally:
+            document.close()
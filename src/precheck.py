@@ -0,0 +1,55 @@
+import re
+from typing import Any, Dict, Optional
+
+
+# --------------------------------------------------
+# PRE-LLM COMPLIANCE CHECK
+# --------------------------------------------------
+# Patterns are deliberately broad: a miss here only costs an LLM call,
+# while a false "Missing" would wrongly fail a valid document.
+_PRECHECK_PATTERNS = {
+    "patient_name": re.compile(r"\b(?:patient|name|pt\s*:|mrs?\.?\s)", re.IGNORECASE),
+    "date": re.compile(
+        r"\b\d{1,2}[/.-]\d{1,2}[/.-]\d{2,4}\b|\b\d{4}[/.-]\d{1,2}[/.-]\d{1,2}\b"
+        r"|\b\d{1,2}\s*(?:jan|feb|mar|apr|may|jun|jul|aug|sep|oct|nov|dec)[a-z]*\.?,?\s*\d{2,4}\b"
+        r"|\bdate\b",
+        re.IGNORECASE
+    ),
+    "medication": re.compile(
+        r"\b\d+(?:\.\d+)?\s?(?:mg|ml|mcg|g|iu|units?)\b|\b(?:tab|tablet|cap|capsule|syp|syrup|inj)\b",
+        re.IGNORECASE
+    ),
+    "physician_signature": re.compile(r"\bDr\b\.?|signature|signed|/s/|\b(?:MD|MBBS)\b", re.IGNORECASE),
+}
+
+_PRECHECK_LABELS = {
+    "patient_name": "Patient Name",
+    "date": "Date",
+    "medication": "Medication",
+    "physician_signature": "Physician Signature",
+}
+
+def quick_compliance_precheck(ocr_text: str) -> Optional[Dict[str, Any]]:
+    """
+    Returns the FAILED result without calling the LLM when the OCR text is
+    missing at least two of date, medication and physician signature.
+    Empty text is not judged: it may mean OCR itself failed, so the
+    Vision LLM still gets to read the images.
+    """
+    if not ocr_text.strip():
+        return None
+
+    summary = {
+        key: "Found" if pattern.search(ocr_text) else "Missing"
+        for key, pattern in _PRECHECK_PATTERNS.items()
+    }
+    decisive = ("date", "medication", "physician_signature")
+    if sum(summary[key] == "Missing" for key in decisive) < 2:
+        return None
+
+    missing = ", ".join(_PRECHECK_LABELS[key] for key, status in summary.items() if status == "Missing")
+    return {
+        "document_status": "FAILED",
+        "compliance_summary": summary,
+        "failure_reason": f"The document failed validation because the following specific item(s) are missing: {missing}"
+    }
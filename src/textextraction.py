@@ -1,20 +1,49 @@
 
 import os
-import gc
-from typing import Dict
+import re
+import logging
+import time
+import random
+import asyncio
+import weakref
+import functools
+import tempfile
 from pathlib import Path
+from typing import Callable, Dict, List, Optional, Tuple, TypeVar
+
+from src import ocr_cache
+from src.precheck import quick_compliance_precheck
+from src.pdfconverter import pdf_page_count, split_pdf_pages
+from src.config import (
+    MAX_CONCURRENT_OCR,
+    LLAMA_RPS,
+    LLAMA_MAX_RETRIES,
+    LLAMA_BACKOFF_BASE_S,
+    LLAMA_BACKOFF_CAP_S,
+    OCR_BREAKER_THRESHOLD,
+    OCR_BREAKER_COOLDOWN_S,
+    OCR_TIMEOUT_S,
+    OCR_CONCURRENCY,
+    LOCAL_IMAGE_OCR,
+    LOCAL_OCR_MIN_CONFIDENCE,
+    PAGES_PER_BATCH,
+)
 
 from llama_cloud_services import LlamaParse
-from llama_index.core import SimpleDirectoryReader
+import aiopytesseract
 
+import httpx
 from dotenv import load_dotenv
 load_dotenv()
 
+log = logging.getLogger(__name__)
+
 
 # --------------------------------------------------
 # FILE EXTENSION HANDLERS
 # --------------------------------------------------
-ALLOWED_EXTENSIONS = {".jpg", ".jpeg", ".png", ".pdf"}
+ALLOWED_EXTENSIONS = frozenset({".jpg", ".jpeg", ".png", ".pdf"})
+IMAGE_EXTENSIONS = frozenset({".jpg", ".jpeg", ".png"})
 MIN_FILE_SIZE = 1024  # 1 KB minimum
 MAX_FILE_SIZE = 100 * 1024 * 1024  # 100 MB maximum
 
@@ -45,70 +74,539 @@ def _validate_file(file_path: str) -> tuple[bool, str]:
         return False, f"Error: {str(e)}"
 
 
+# --------------------------------------------------
+# PER-EVENT-LOOP STATE
+# --------------------------------------------------
+T = TypeVar("T")
+
+
+def _loop_local(factory: Callable[[], T]) -> Callable[[], T]:
+    """
+    Returns a getter that lazily builds one factory() instance per running
+    event loop. asyncio primitives and pooled connections are bound to the
+    loop that first uses them, so module-level instances break under
+    more than one loop (test runners, asyncio.run per call, reloads).
+    """
+    instances: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, T]" = weakref.WeakKeyDictionary()
+
+    def get() -> T:
+        loop = asyncio.get_running_loop()
+        instance = instances.get(loop)
+        if instance is None:
+            instance = instances[loop] = factory()
+        return instance
+
+    return get
+
+
+# --------------------------------------------------
+# SHARED PARSER
+# --------------------------------------------------
+# Parsers are built on first use (not at import) and then shared: the sync
+# one process-wide, the async one per event loop. ignore_errors=False so rate
+# limits and server errors reach the retry layer instead of silently coming
+# back as an empty result. max_timeout bounds job polling, and LlamaParse also
+# assigns it as the httpx timeout of whichever client it uses (including the
+# pooled custom_client), so it governs connect/read/write/pool waits too.
+def _new_parser(**kwargs) -> LlamaParse:
+    return LlamaParse(
+        api_key=os.getenv("LLAMA_API_KEY"),
+        result_type="text",
+        ignore_errors=False,
+        max_timeout=int(OCR_TIMEOUT_S),
+        **kwargs
+    )
+
+
+def _new_http_client() -> httpx.AsyncClient:
+    """
+    Pooled client for the async path, sized to the OCR semaphore. No timeout
+    is set here: LlamaParse overwrites it with max_timeout on every use.
+    """
+    return httpx.AsyncClient(
+        limits=httpx.Limits(
+            max_connections=MAX_CONCURRENT_OCR,
+            max_keepalive_connections=MAX_CONCURRENT_OCR
+        )
+    )
+
+
+@functools.cache
+def _get_parser() -> LlamaParse:
+    """
+    Parser for the sync path. parse() runs its own short-lived event loop,
+    so it keeps LlamaParse's per-call client rather than the pooled one.
+    """
+    return _new_parser()
+
+
+_get_http_client = _loop_local(_new_http_client)
+
+# Parser for the async path, reusing the loop's pooled keep-alive connections
+_get_async_parser = _loop_local(lambda: _new_parser(custom_client=_get_http_client()))
+
+
+async def warm_up() -> None:
+    """
+    Opens MAX_CONCURRENT_OCR connections to LlamaParse ahead of the first
+    request so no OCR call pays the TLS handshake. Failures are harmless.
+    """
+    client = _get_http_client()
+    base_url = str(_get_async_parser().base_url)
+    results = await asyncio.gather(
+        *[client.get(base_url) for _ in range(MAX_CONCURRENT_OCR)],
+        return_exceptions=True
+    )
+    failures = sum(isinstance(result, Exception) for result in results)
+    if failures:
+        log.info("OCR connection warm-up: %d/%d requests failed", failures, len(results))
+
+
+def _job_text(result) -> str:
+    """Joins the page texts of a LlamaParse job result (Page.text may be None)."""
+    return "\n".join(page.text or "" for page in result.pages).strip()
+
+
+def _sync_extract(file_path: str) -> str:
+    """Runs LlamaParse on a single file and joins the page texts."""
+    return _job_text(_get_parser().parse(file_path))
+
+
+async def _aparse_one(file_path: str) -> str:
+    """
+    Runs LlamaParse on one file as its own job. Files are never parsed in a
+    shared aparse([...]) call: that gathers its jobs without return_exceptions,
+    so one bad file would fail every file alongside it.
+    """
+    return _job_text(await _get_async_parser().aparse(file_path))
+
+
+# --------------------------------------------------
+# OCR CACHE LOOKUP
+# --------------------------------------------------
+def _cache_lookup(file_path: str) -> Tuple[Optional[str], Optional[str]]:
+    """Returns (content digest, cached text); both None if the file can't be read."""
+    try:
+        digest = ocr_cache.file_digest(file_path)
+    except OSError:
+        return None, None
+    return digest, ocr_cache.get(digest)
+
+
+def cached_text(file_path: str) -> Optional[str]:
+    """Returns previously extracted text for this file's content, or None."""
+    return _cache_lookup(file_path)[1]
+
+
 # --------------------------------------------------
 # SYNCHRONOUS OCR EXTRACTION
 # --------------------------------------------------
+def _extract_uncached(file_path: str, digest: Optional[str]) -> str:
+    """Validates and parses a file with LlamaParse, storing the text under digest."""
+    is_valid, msg = _validate_file(file_path)
+    if not is_valid:
+        log.warning("File validation failed: %s (%s)", msg, file_path)
+        return ""
+
+    filename = os.path.basename(file_path)
+    log.info("OCR extraction: %s", filename)
+
+    try:
+        text = _sync_extract(file_path)
+    except FileNotFoundError:
+        log.warning("OCR input disappeared: %s", file_path)
+        return ""
+    except Exception:
+        log.exception("OCR failed: %s", file_path)
+        return ""
+
+    if not text:
+        log.warning("No text extracted from %s", filename)
+        return ""
+
+    if digest is not None:
+        ocr_cache.set(digest, text)
+    log.info("OCR success: %s (%d chars)", filename, len(text))
+    return text
+
+
 def extract_text_from_image(file_path: str) -> str:
     """
-    Extract text from image/PDF using LlamaParse (PURE SYNC).
-    
-    KEY: Creates FRESH parser for each image to avoid event loop conflicts.
-    Old parser's event loop closes cleanly, new one starts fresh.
+    Extract text from image/PDF using the shared LlamaParse parser (SYNC).
+
+    Identical content already parsed is served from the OCR cache.
+    Returns an empty string when validation or extraction fails.
+    """
+    digest, cached = _cache_lookup(file_path)
+    if cached is not None:
+        return cached
+    return _extract_uncached(file_path, digest)
+
+
+# --------------------------------------------------
+# RATE LIMITING & RETRIES
+# --------------------------------------------------
+class AsyncRateLimiter:
+    """Spaces LlamaParse requests at least 1/rps seconds apart."""
+
+    def __init__(self, rps: float) -> None:
+        self.min_interval: float = 1.0 / rps if rps > 0 else 0.0
+        self.last_call: float = float("-inf")
+        self._lock = asyncio.Lock()
+
+    async def acquire(self) -> None:
+        async with self._lock:
+            loop = asyncio.get_running_loop()
+            wait = self.min_interval - (loop.time() - self.last_call)
+            if wait > 0:
+                await asyncio.sleep(wait)
+            self.last_call = loop.time()
+
+
+# Status codes only count in an explicit status context ("status_code 503",
+# "HTTP 429"), so texts like "exceeds 500 pages" are not retried
+_STATUS_CONTEXT = r"\b(?:status(?:[_ ]?code)?|http(?:/\d(?:\.\d)?)?)\W*"
+_RATE_LIMIT_PATTERN = re.compile(
+    _STATUS_CONTEXT + r"429\b|rate.?limit|quota|too many requests", re.IGNORECASE
+)
+_SERVER_ERROR_PATTERN = re.compile(_STATUS_CONTEXT + r"5\d\d\b", re.IGNORECASE)
+
+
+def _is_rate_limited(exc: Exception) -> bool:
+    """True for provider throttling (429 / rate limit / quota)."""
+    if isinstance(exc, httpx.HTTPStatusError):
+        return exc.response.status_code == 429
+    return bool(_RATE_LIMIT_PATTERN.search(str(exc)))
+
+
+def _is_retryable(exc: Exception) -> bool:
+    """
+    True for throttling and transient server/network failures. httpx errors
+    are classified by type/status; LlamaParse wraps most HTTP failures in
+    generic exceptions, so those are classified by message.
+    """
+    if isinstance(exc, httpx.HTTPStatusError):
+        status = exc.response.status_code
+        return status == 429 or status >= 500
+    if isinstance(exc, (httpx.TransportError, TimeoutError)):
+        return True
+    if isinstance(exc, (FileNotFoundError, ValueError)):
+        return False
+    return _is_rate_limited(exc) or bool(_SERVER_ERROR_PATTERN.search(str(exc)))
+
+
+def _backoff_delay(attempt: int) -> float:
+    """Exponential backoff with full-second jitter, capped."""
+    return min(LLAMA_BACKOFF_CAP_S, LLAMA_BACKOFF_BASE_S * 2 ** attempt + random.random())
+
+
+class Breaker:
+    """
+    Circuit breaker for LlamaParse: after `threshold` consecutive failures
+    calls are skipped for `cooldown_s`, then a single probe is let through.
+    A successful probe closes the circuit; a failed one re-opens it.
+    """
+
+    def __init__(self, threshold: int, cooldown_s: float) -> None:
+        self.threshold: int = threshold
+        self.cooldown_s: float = cooldown_s
+        self.state: str = "closed"
+        self.fails: int = 0
+        self.opened_at: float = 0.0
+
+    def allow(self) -> bool:
+        if self.state == "closed":
+            return True
+        if time.monotonic() - self.opened_at < self.cooldown_s:
+            return False
+        # Cool-down over: admit one probe (re-armed if it never reports back)
+        self.state = "half_open"
+        self.opened_at = time.monotonic()
+        return True
+
+    def record_success(self) -> None:
+        self.state = "closed"
+        self.fails = 0
+
+    def record_failure(self) -> None:
+        self.fails += 1
+        if self.state == "half_open" or self.fails >= self.threshold:
+            self.state = "open"
+            self.opened_at = time.monotonic()
+
+
+async def _call_with_retries(label: str, func, *args):
+    """Awaits func(*args), retrying 429/5xx failures with exponential backoff."""
+    for attempt in range(LLAMA_MAX_RETRIES + 1):
+        try:
+            return await func(*args)
+        except Exception as e:
+            if not _is_retryable(e) or attempt == LLAMA_MAX_RETRIES:
+                raise
+            delay = _backoff_delay(attempt)
+            log.warning("OCR throttled: %s, retry %d/%d in %.1fs (%s)",
+                        label, attempt + 1, LLAMA_MAX_RETRIES, delay, str(e) or type(e).__name__)
+            await asyncio.sleep(delay)
+
+
+# --------------------------------------------------
+# LLAMAPARSE CALLS
+# --------------------------------------------------
+async def _parse_one(file_path: str) -> str:
+    """
+    One paced LlamaParse request for a file. A request running past
+    OCR_TIMEOUT_S raises TimeoutError, which the retry layer treats as transient.
+    """
+    await _get_rate_limiter().acquire()
+    async with asyncio.timeout(OCR_TIMEOUT_S):
+        return await _aparse_one(file_path)
+
+
+async def _parse_with_breaker(file_path: str) -> str:
+    """
+    _parse_one with retries, reporting to the breaker once per file. Only a
+    file whose retries ran out on a server/network error counts as an outage:
+    throttling is routine for LlamaParse, and a rejected or missing file says
+    nothing about the provider.
     """
     try:
-        is_valid, msg = _validate_file(file_path)
-        if not is_valid:
-            print(f"File validation failed: {msg}")
-            return ""
-        
-        filename = os.path.basename(file_path)
-        print(f"→ OCR extraction: {filename}")
-        
-        # CRITICAL: Create FRESH parser for this image (not global)
-        # This ensures each image gets a clean event loop context
-        fresh_parser = LlamaParse(
-            api_key=os.getenv("LLAMA_API_KEY"),
-            result_type="text"
-        )
-        
-        # Create extractor dict with fresh parser
-        fresh_extractor = {
-            ".jpg": fresh_parser,
-            ".jpeg": fresh_parser,
-            ".png": fresh_parser,
-            ".pdf": fresh_parser,
-        }
-        
-        # Extract text with fresh parser
-        documents = SimpleDirectoryReader(
-            input_files=[file_path],
-            file_extractor=fresh_extractor
-        ).load_data()
-        
-        if not documents:
-            print(f"✗ No text extracted from {filename}")
-            return ""
-        
-        text = "\n".join(doc.text for doc in documents).strip()
-        print(f"✓ OCR success: {filename} ({len(text)} chars)")
-        
-        # Clean up parser (allows its event loop to close properly)
-        del fresh_parser
-        del fresh_extractor
-        gc.collect()  # Force garbage collection to clean up old event loops
-        
-        return text
-        
+        text = await _call_with_retries(os.path.basename(file_path), _parse_one, file_path)
     except Exception as e:
-        error_msg = str(e)
-        print(f"✗ OCR failed: {error_msg[:150]}")
-        
-        # On error, still try to clean up
+        if _is_retryable(e) and not _is_rate_limited(e):
+            ocr_breaker.record_failure()
+        raise
+    ocr_breaker.record_success()
+    return text
+
+
+# --------------------------------------------------
+# ASYNC OCR EXTRACTION
+# --------------------------------------------------
+# The semaphore caps simultaneous LlamaParse jobs so large batches queue
+# instead of tripping the provider's rate limits. It and the rate limiter are
+# created lazily per event loop; the breaker is plain state.
+_get_semaphore = _loop_local(lambda: asyncio.Semaphore(MAX_CONCURRENT_OCR))
+_get_rate_limiter = _loop_local(lambda: AsyncRateLimiter(LLAMA_RPS))
+# Local Tesseract runs are CPU-bound, so they get their own CPU-sized limit
+_get_tesseract_semaphore = _loop_local(lambda: asyncio.Semaphore(OCR_CONCURRENCY))
+ocr_breaker = Breaker(OCR_BREAKER_THRESHOLD, OCR_BREAKER_COOLDOWN_S)
+
+
+async def _extract_with_retries(file_path: str, digest: Optional[str]) -> str:
+    """
+    Parses a file with LlamaParse (requests paced by the rate limiter),
+    retrying 429/5xx failures with exponential backoff. Returns "" on failure.
+    """
+    filename = os.path.basename(file_path)
+    log.info("OCR extraction: %s", filename)
+
+    try:
+        text = await _parse_with_breaker(file_path)
+    except FileNotFoundError:
+        log.warning("OCR input disappeared: %s", file_path)
+        return ""
+    except Exception:
+        log.exception("OCR failed: %s", file_path)
+        return ""
+
+    if not text:
+        log.warning("No text extracted from %s", filename)
+        return ""
+
+    if digest is not None:
+        ocr_cache.set(digest, text)
+    log.info("OCR success: %s (%d chars)", filename, len(text))
+    return text
+
+
+def _tesseract_text(words) -> Tuple[str, float]:
+    """Rebuilds line text from Tesseract word data; returns (text, mean word confidence)."""
+    lines: Dict[Tuple[int, int, int, int], List[str]] = {}
+    confidences: List[float] = []
+    for word in words:
+        text = (word.text or "").strip()
+        if not text or float(word.conf) < 0:
+            continue
+        lines.setdefault((word.page_num, word.block_num, word.par_num, word.line_num), []).append(text)
+        confidences.append(float(word.conf))
+    text = "\n".join(" ".join(line) for line in lines.values())
+    return text, (sum(confidences) / len(confidences) if confidences else 0.0)
+
+
+async def _local_ocr(file_path: str) -> str:
+    """
+    OCR for an image with local Tesseract. Returns "" so the caller falls back
+    to LlamaParse on any failure (missing binary, timeout, unreadable image),
+    on empty or low-confidence output, and when the text fails the compliance
+    precheck: noisy OCR of a handwritten prescription must not FAIL a valid
+    document. Local text is never written to the shared OCR cache.
+    """
+    filename = os.path.basename(file_path)
+    try:
+        async with _get_tesseract_semaphore():
+            words = await aiopytesseract.image_to_data(file_path, timeout=OCR_TIMEOUT_S)
+    except Exception as e:
+        log.warning("Local OCR failed, falling back to LlamaParse: %s (%s)", filename, str(e) or type(e).__name__)
+        return ""
+
+    text, confidence = _tesseract_text(words)
+    if not text:
+        log.info("Local OCR found no text, falling back to LlamaParse: %s", filename)
+        return ""
+    if confidence < LOCAL_OCR_MIN_CONFIDENCE:
+        log.info("Local OCR confidence %.0f too low, falling back to LlamaParse: %s", confidence, filename)
+        return ""
+    if quick_compliance_precheck(text) is not None:
+        log.info("Local OCR text fails the precheck, falling back to LlamaParse: %s", filename)
+        return ""
+
+    log.info("Local OCR success: %s (%d chars, confidence %.0f)", filename, len(text), confidence)
+    return text
+
+
+async def _extract_remote(file_path: str, digest: Optional[str] = None) -> str:
+    """LlamaParse OCR for one file (or single-page PDF) in its own OCR slot."""
+    async with _get_semaphore():
+        return await _extract_with_retries(file_path, digest)
+
+
+async def _parse_page(page_path: str) -> str:
+    """LlamaParse text of one single-page PDF in its own OCR slot; raises on failure."""
+    async with _get_semaphore():
+        return await _parse_with_breaker(page_path)
+
+
+async def _extract_pdf_pages(file_path: str, digest: Optional[str], page_count: int) -> str:
+    """
+    Splits a multi-page PDF into single-page PDFs and OCRs the pages
+    concurrently, PAGES_PER_BATCH at a time, joining the texts in page order.
+    Only complete text is cached: if any page fails the document is treated
+    as a miss (""), so a truncated text is never served on re-upload. PDFs
+    that can't be split (e.g. encrypted) are parsed as a whole instead.
+    """
+    filename = os.path.basename(file_path)
+    log.info("OCR extraction: %s (%d pages)", filename, page_count)
+
+    texts: List[str] = []
+    with tempfile.TemporaryDirectory(prefix="ocr_pages_") as page_dir:
+        for start in range(0, page_count, PAGES_PER_BATCH):
+            try:
+                page_paths = await asyncio.to_thread(
+                    split_pdf_pages, file_path, page_dir, start, start + PAGES_PER_BATCH
+                )
+            except Exception as e:
+                log.warning("PDF page split failed, parsing whole file: %s (%s)", file_path, e)
+                return await _extract_remote(file_path, digest)
+
+            outcomes = await asyncio.gather(*[_parse_page(path) for path in page_paths], return_exceptions=True)
+            failed = [
+                (path, outcome) for path, outcome in zip(page_paths, outcomes)
+                if isinstance(outcome, BaseException)
+            ]
+            if failed:
+                for path, outcome in failed:
+                    log.warning("OCR failed for page %s of %s (%s)",
+                                os.path.basename(path), file_path, str(outcome) or type(outcome).__name__)
+                log.warning("OCR incomplete, not caching: %s (%d pages failed)", file_path, len(failed))
+                return ""
+
+            texts.extend(outcomes)
+            for path in page_paths:
+                os.remove(path)
+
+    text = "\n".join(filter(None, texts)).strip()
+    if not text:
+        log.warning("No text extracted from %s", filename)
+        return ""
+    if digest is not None:
+        ocr_cache.set(digest, text)
+    log.info("OCR success: %s (%d chars)", filename, len(text))
+    return text
+
+
+async def _extract_miss(file_path: str, digest: Optional[str], ext: str) -> str:
+    """
+    Validates a cache miss and parses it: Tesseract first for images, then
+    LlamaParse (page by page for multi-page PDFs).
+    """
+    is_valid, msg = _validate_file(file_path)
+    if not is_valid:
+        log.warning("File validation failed: %s (%s)", msg, file_path)
+        return ""
+
+    if LOCAL_IMAGE_OCR and ext in IMAGE_EXTENSIONS:
+        text = await _local_ocr(file_path)
+        if text:
+            return text
+
+    # During a LlamaParse outage fail fast instead of paying timeouts per file
+    if not ocr_breaker.allow():
+        log.warning("OCR skipped (circuit open): %s", os.path.basename(file_path))
+        return ""
+
+    if ext == ".pdf":
         try:
-            gc.collect()
-        except:
-            pass
-        
+            page_count = await asyncio.to_thread(pdf_page_count, file_path)
+        except Exception:
+            # Unreadable locally; let LlamaParse try the whole file
+            page_count = 1
+        if page_count > 1:
+            return await _extract_pdf_pages(file_path, digest, page_count)
+
+    return await _extract_remote(file_path, digest)
+
+
+# In-flight misses keyed by content digest (path if unreadable), so concurrent
+# requests for the same document share one LlamaParse job
+_get_inflight = _loop_local(dict)
+
+
+async def extract_text_from_image_async(file_path: str) -> str:
+    """
+    Async OCR entry point. The cache lookup (hashing + sqlite) runs in a
+    worker thread and cache hits return without taking an OCR slot. Image
+    misses try local Tesseract first; the rest wait on the OCR semaphore
+    before calling LlamaParse. Concurrent
+    misses for the same content await a single extraction. Multi-page
+    PDFs are parsed page by page, with the pages running concurrently.
+    """
+    # Misrouted files are rejected before hashing, an OCR slot or the network
+    ext = os.path.splitext(file_path)[1].lower()
+    if ext not in ALLOWED_EXTENSIONS:
+        log.warning("Unsupported file type: %s (%s)", ext, file_path)
         return ""
 
+    digest, cached = await asyncio.to_thread(_cache_lookup, file_path)
+    if cached is not None:
+        return cached
+
+    key = digest or os.path.abspath(file_path)
+    inflight: Dict[str, "asyncio.Task[str]"] = _get_inflight()
+    task = inflight.get(key)
+    if task is None:
+        task = inflight[key] = asyncio.ensure_future(_extract_miss(file_path, digest, ext))
+        task.add_done_callback(lambda _: inflight.pop(key, None))
+    # Shielded so one caller's cancellation doesn't abort the shared job
+    return await asyncio.shield(task)
+
 
+# Coroutines created per gather() call; bounds memory for very large file lists
+_FANOUT_CHUNK = 256
+
+
+async def extract_many(file_paths: List[str]) -> Dict[str, str]:
+    """
+    Concurrent OCR for many files via extract_text_from_image_async (so cache
+    hits, in-flight dedupe and the OCR semaphore all apply). Use this instead of
+    awaiting files one by one. Failures map to "".
+    """
+    results: Dict[str, str] = {}
+    for start in range(0, len(file_paths), _FANOUT_CHUNK):
+        chunk = file_paths[start:start + _FANOUT_CHUNK]
+        texts = await asyncio.gather(
+            *[extract_text_from_image_async(path) for path in chunk],
+            return_exceptions=True
+        )
+        for path, text in zip(chunk, texts):
+            results[path] = text if isinstance(text, str) else ""
+    return results